@@ -18,8 +18,11 @@ parser.add_argument('--piezo-write-channels', metavar = '<ch0,ch1,ch2>', default
 parser.add_argument('--piezo-read-channels', metavar = '<ch0,ch1,ch2>', default = 'ai0,ai1,ai2', type=str,
                     help='List of analog input channels used to read the piezo position')
 parser.add_argument('-s', '--settle-time', metavar = 'settle_time', default = 0.01, type=float,
-                    help='''Amount of time, in seconds, that are paused after moving to a new position. 
-This allows for the device to "settle" into position.''')
+                    help='''Maximum amount of time, in seconds, that is paused after moving to a new position.
+This allows for the device to "settle" into position. The actual pause is proportional
+to the distance moved (see --settle-time-per-micron), up to this value.''')
+parser.add_argument('--settle-time-per-micron', metavar = 'seconds', default = 0.005, type=float,
+                    help='Amount of time, in seconds per micron of the largest axis move, that is paused after moving.')
 parser.add_argument('-q', '--quiet', action = 'store_true',
                     help='When true,logger level will be set to warning. Otherwise, set to "info".')
 parser.add_argument('-t', '--test', action = 'store_true',
@@ -226,6 +229,7 @@ def build_controller():
                                   write_channels = args.piezo_write_channels.split(','),
                                   read_channels = args.piezo_read_channels.split(','),
                                   move_settle_time = args.settle_time,
+                                  move_settle_time_per_micron = args.settle_time_per_micron,
                                   min_position = args.piezo_min_position,
                                   max_position = args.piezo_max_position,
                                   scale_microns_per_volt = piezo_scale_microns_per_volt,
@@ -233,8 +237,9 @@ def build_controller():
     return controller
 
 def main():
-    tkapp = MainTkApplication(build_controller())
-    tkapp.run()
+    with build_controller() as controller:
+        tkapp = MainTkApplication(controller)
+        tkapp.run()
 
 if __name__ == '__main__':
     main()
@@ -1,24 +1,55 @@
 import nidaqmx
+import nidaqmx.stream_readers
+import nidaqmx.stream_writers
+import numpy as np
 import logging
 import time
 from typing import List, Union, Tuple
 
 logger = logging.getLogger(__name__)
 
+_NUMERIC_TYPES = (int, float, np.integer, np.floating)
+
 class BaseControl:
     def __init__(self, min_allowed_position = 0.0, max_allowed_position = 80.0):
         self.minimum_allowed_position = min_allowed_position
         self.maximum_allowed_position = max_allowed_position
         self.last_write_values = [0, 0, 0]
+        # step from the last commanded position rather than reading the position back
+        self._use_commanded_for_step = True
+
+    @property
+    def minimum_allowed_position(self) -> float:
+        return self._minimum_allowed_position
+
+    @minimum_allowed_position.setter
+    def minimum_allowed_position(self, value: float) -> None:
+        self._minimum_allowed_position = float(value)
+        self._update_limits()
+
+    @property
+    def maximum_allowed_position(self) -> float:
+        return self._maximum_allowed_position
+
+    @maximum_allowed_position.setter
+    def maximum_allowed_position(self, value: float) -> None:
+        self._maximum_allowed_position = float(value)
+        self._update_limits()
+
+    def _update_limits(self) -> None:
+        '''
+        Called whenever the allowed position range changes. Subclasses may
+        override this to refresh any values derived from the range.
+        '''
+        pass
 
     def _validate_value(self, position: float) -> None:
-        position = float(position)
-        if type(position) not in [type(1.0), type(1)]:
+        if not isinstance(position, _NUMERIC_TYPES):
             raise TypeError(f'value {position} is not a valid type.')
-        if position < self.minimum_allowed_position:
-            raise ValueError(f'value {position} is less than {self.minimum_allowed_position:.3f}.')
-        if position > self.maximum_allowed_position:
-            raise ValueError(f'value {position} is greater than {self.maximum_allowed_position:.3f}.')
+        if not (self._minimum_allowed_position <= position <= self._maximum_allowed_position):
+            if position < self._minimum_allowed_position:
+                raise ValueError(f'value {position} is less than {self._minimum_allowed_position:.3f}.')
+            raise ValueError(f'value {position} is greater than {self._maximum_allowed_position:.3f}.')
 
     def check_allowed_position(self, x: float = None,
                                      y: float = None,
@@ -48,29 +79,53 @@ class BaseControl:
 
         You do not need to specify all three axis values in order
         to move in one direction. For example, you can call: step(dz = 0.5)
+
+        Steps are taken from the last commanded position. The position is
+        only read back if an axis has not yet been written.
+        All axes are moved together in a single call to go_to_position.
+        Any axis whose step would leave the allowed range is not moved. No
+        axis is moved if a stepped axis has an unknown position.
         '''
-        x, y, z = self.get_current_position()
-
-        if dx:
-            try:
-                self.go_to_position(x = x + dx)
-            except ValueError as e:
-                logger.error(f'Trying to step outside of allowed range ({self.minimum_allowed_position:.2f}, {self.maximum_allowed_position:.2f}).')
-        if dy:
-            try:
-                self.go_to_position(y = y + dy)
-            except ValueError as e:
-                logger.error(f'Trying to step outside of allowed range ({self.minimum_allowed_position:.2f}, {self.maximum_allowed_position:.2f}).')
-        if dz:
-            try:
-                self.go_to_position(z = z + dz)
-            except ValueError as e:
-                logger.error(f'Trying to step outside of allowed range ({self.minimum_allowed_position:.2f}, {self.maximum_allowed_position:.2f}).')
+        if self._use_commanded_for_step and None not in self.last_write_values:
+            current = self.last_write_values
+        else:
+            current = self.get_current_position()
+
+        unknown_axes = [name for name, delta, pos in zip('xyz', (dx, dy, dz), current) if delta is not None and pos is None]
+        if unknown_axes:
+            logger.error('Cannot step along %s: current position is unknown until the axis has been written.', ', '.join(unknown_axes))
+            return
+
+        provided = np.array([delta is not None for delta in (dx, dy, dz)])
+        deltas = np.array([0.0 if delta is None else delta for delta in (dx, dy, dz)], dtype=np.float64)
+        new_position = np.asarray(current, dtype=np.float64) + deltas
+
+        in_range = (new_position >= self._minimum_allowed_position) & (new_position <= self._maximum_allowed_position)
+        if not in_range[provided].all():
+            out_of_range_axes = ['xyz'[i] for i in np.flatnonzero(provided & ~in_range)]
+            logger.error('Trying to step outside of allowed range (%.2f, %.2f) along %s.',
+                         self.minimum_allowed_position, self.maximum_allowed_position, ', '.join(out_of_range_axes))
+
+        move = provided & in_range
+        if move.any():
+            self.go_to_position(*[float(v) if m else None for v, m in zip(new_position, move)])
 
     def get_current_position(self) -> List[float]:
 
         return self.last_write_values
 
+    def close(self) -> None:
+        '''
+        Releases any hardware resources held by the controller.
+        '''
+        pass
+
+    def __enter__(self) -> 'BaseControl':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
 
 class PiezoControl(BaseControl):
 
@@ -81,23 +136,55 @@ class PiezoControl(BaseControl):
                        zero_microns_volt_offset: Union[float, int, Tuple[float, float, float]] = 0,
                        move_settle_time: float = 0.001,
                        min_position: float = 0.0,
-                       max_position: float = 80.0) -> None:
+                       max_position: float = 80.0,
+                       move_settle_time_per_micron: float = 0.005,
+                       min_move_settle_time: float = 0.0) -> None:
         super().__init__(min_allowed_position = min_position, max_allowed_position = max_position)
 
         self.device_name = device_name
         self.write_channels = write_channels
         self.read_channels = read_channels
+        self._write_paths = [f'{device_name}/{channel}' for channel in write_channels]
+        self._read_paths = None if read_channels is None else [f'{device_name}/{channel}' for channel in read_channels]
 
         self.scale_microns_per_volt = scale_microns_per_volt
         self.zero_microns_volt_offset = zero_microns_volt_offset
 
         self.minimum_allowed_position = min_position
         self.maximum_allowed_position = max_position
-        self.settling_time_in_seconds = move_settle_time #10 millisecond settle time
+        self.settling_time_in_seconds = move_settle_time #maximum settle time after a move
+        # the settling wait scales with the size of the move and is capped at settling_time_in_seconds
+        self.settling_time_per_micron_in_seconds = move_settle_time_per_micron
+        self.minimum_settling_time_in_seconds = min_move_settle_time
         self.last_write_values = [None, None, None]
+        self._last_write_volts = [None, None, None]
+
+        # tasks are created once and reused for every read/write. Creating a
+        # task and adding a channel on each call dominates the move latency.
+        # All three axes share a single task so that a move is one driver call.
+        self._ao_task = None
+        self._ai_task = None
+        self._ai_reader = None
+        self._ai_buffer = None
+        try:
+            self._ao_task = nidaqmx.Task()
+            for path in self._write_paths:
+                self._ao_task.ao_channels.add_ao_voltage_chan(path)
+            self._ao_task.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+
+            if self.read_channels is not None:
+                self._ai_task = nidaqmx.Task()
+                for path in self._read_paths:
+                    self._ai_task.ai_channels.add_ai_voltage_chan(path, min_val = 0, max_val = 10.0)
+                self._ai_task.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+                self._ai_reader = nidaqmx.stream_readers.AnalogMultiChannelReader(self._ai_task.in_stream)
+                self._ai_buffer = np.zeros(len(self.read_channels), dtype=np.float64)
+        except Exception:
+            self.close()
+            raise
 
     def _microns_to_volts(self, microns: float, axis: int) -> float:
-        return microns / self.scale_microns_per_volt[axis] + self.zero_microns_volt_offset[axis]
+        return microns * self._inv_scale[axis] + self._zero_microns_volt_offset[axis]
 
     def _volts_to_microns(self, volts: float, axis: int) -> float:
         return self.scale_microns_per_volt[axis] * (volts - self.zero_microns_volt_offset[axis])
@@ -126,6 +213,9 @@ class PiezoControl(BaseControl):
     @scale_microns_per_volt.setter
     def scale_microns_per_volt(self, value: Union[float, int, Tuple[float, float, float]]) -> None:
         self._scale_microns_per_volt = self._convert_value_to_ntuple(value, 3)
+        self._scale_array = np.array(self._scale_microns_per_volt, dtype=np.float64)
+        self._inv_scale = tuple(1.0 / s for s in self._scale_microns_per_volt)
+        self._update_limits()
 
     @property
     def zero_microns_volt_offset(self) -> Tuple[float, float, float]:
@@ -134,6 +224,39 @@ class PiezoControl(BaseControl):
     @zero_microns_volt_offset.setter
     def zero_microns_volt_offset(self, value: Union[float, int, Tuple[float, float, float]]) -> None:
         self._zero_microns_volt_offset = self._convert_value_to_ntuple(value, 3)
+        self._offset_array = np.array(self._zero_microns_volt_offset, dtype=np.float64)
+        self._update_limits()
+
+    def _update_limits(self) -> None:
+        '''
+        Caches the allowed position range of each axis in volts so that
+        positions can be validated after conversion to volts.
+        '''
+        if getattr(self, '_inv_scale', None) is None or getattr(self, '_zero_microns_volt_offset', None) is None:
+            return
+        bounds = [(self._microns_to_volts(self._minimum_allowed_position, i),
+                   self._microns_to_volts(self._maximum_allowed_position, i)) for i in range(3)]
+        self._min_volts = tuple(min(b) for b in bounds)
+        self._max_volts = tuple(max(b) for b in bounds)
+
+    def _check_open(self) -> None:
+        if self._ao_task is None:
+            raise RuntimeError('controller is closed')
+
+    def _settling_time(self, old_values: List[float], new_values: List[float]) -> float:
+        '''
+        Returns the time to wait after moving from old_values to new_values.
+
+        The wait is proportional to the largest single axis displacement,
+        bounded below by minimum_settling_time_in_seconds and above by
+        settling_time_in_seconds. If any previous position is unknown, the
+        full settling_time_in_seconds is returned.
+        '''
+        if None in old_values:
+            return self.settling_time_in_seconds
+        delta = max(abs(new - old) for new, old in zip(new_values, old_values))
+        settle_time = self.settling_time_per_micron_in_seconds * delta + self.minimum_settling_time_in_seconds
+        return min(self.settling_time_in_seconds, settle_time)
 
     def go_to_position(self, x: float = None,
                              y: float = None,
@@ -143,32 +266,158 @@ class PiezoControl(BaseControl):
 
         You do not need to specify all three axis values in order
         to move in one direction. For example, you can call: go_to_position(z = 40)
+        All three output channels are written on every move, so unspecified
+        axes are held at their last written position. If an axis has never
+        been written, its position is read back from the input channels and
+        that channel is driven to the measured position. Any read-back error
+        therefore moves that axis slightly on the first move. Without input
+        channels, the first move must specify all three axes, for example:
+        go_to_position(x = 20, y = 20, z = 20)
+
+        raises ValueError if try to set position out of bounds, or if an
+        unspecified axis has never been written and no read channels exist.
+        '''
 
-        raises ValueError if try to set position out of bounds.
+        new_volts = [None if val is None else self._microns_to_volts(val, idx) for idx, val in enumerate((x, y, z))]
+        self._write_volts(new_volts, [x, y, z])
+
+    def go_to_position_volts(self, vx: float = None,
+                                   vy: float = None,
+                                   vz: float = None) -> None:
         '''
+        Sets the x,y,z position by the voltage written to each output channel.
 
-        def goto(val, idx):
-            self._validate_value(val)
-            with nidaqmx.Task() as task:
-                task.ao_channels.add_ao_voltage_chan(self.device_name + '/' + self.write_channels[idx])
-                task.write(self._microns_to_volts(val, idx))
-                self.last_write_values[idx] = val
+        This skips the conversion from microns for callers that have their
+        own calibration. As with go_to_position, unspecified axes are held at
+        their last written value.
 
-        debug_string = []
-        if x is not None:
-            goto(x, 0)
-            debug_string.append(f'x: {x:.2f}')
-        if y is not None:
-            goto(y, 1)
-            debug_string.append(f'y: {y:.2f}')
-        if z is not None:
-            goto(z, 2)
-            debug_string.append(f'z: {z:.2f}')
+        raises ValueError if a voltage corresponds to a position out of bounds.
+        '''
+        self._write_volts([vx, vy, vz])
+
+    def _check_volts(self, idx: int, volts: float) -> None:
+        if not isinstance(volts, _NUMERIC_TYPES):
+            raise TypeError(f'value {volts} is not a valid type.')
+        if not (self._min_volts[idx] <= volts <= self._max_volts[idx]):
+            raise ValueError(f'{"xyz"[idx]} value {volts:.3f} V is outside of allowed range '
+                             f'({self._min_volts[idx]:.3f}, {self._max_volts[idx]:.3f}) V, '
+                             f'({self.minimum_allowed_position:.2f}, {self.maximum_allowed_position:.2f}) microns.')
+
+    def _write_volts(self, new_volts: List[float], new_values: List[float] = None) -> None:
+        '''
+        Validates and writes voltages to all output channels and waits for
+        the piezo to settle. new_values holds the matching positions in
+        microns and is computed from new_volts if not given.
+        Axes that are None in new_volts are held at their last written value.
+        '''
+        for idx, volts in enumerate(new_volts):
+            if volts is not None:
+                self._check_volts(idx, volts)
+        if new_values is None:
+            new_values = [None if volts is None else self._volts_to_microns(volts, idx) for idx, volts in enumerate(new_volts)]
+
+        self._check_open()
+        requested = list(new_values)
+        for idx, volts in enumerate(new_volts):
+            if volts is None:
+                new_volts[idx] = self._last_write_volts[idx]
+                new_values[idx] = self.last_write_values[idx]
+
+        if None in new_values:
+            # all channels are written together, so any axis not yet
+            # written must be held at its current position.
+            if self.read_channels is None:
+                raise ValueError('all three axes must be specified until each axis has been written once.')
+            current = self.get_current_position()
+            for idx, val in enumerate(new_values):
+                if val is None:
+                    new_values[idx] = current[idx]
+                    new_volts[idx] = self._microns_to_volts(current[idx], idx)
+
+        settle_time = self._settling_time(self.last_write_values, new_values)
+
+        self._ao_task.write(new_volts, auto_start = True)
+        self.last_write_values = new_values
+        self._last_write_volts = new_volts
+
+        if logger.isEnabledFor(logging.INFO):
+            debug_string = [f'{name}: {val:.2f}' for name, val in zip('xyz', requested) if val is not None]
+            logger.info('go to position %s', ' '.join(debug_string))
+
+        time.sleep(settle_time) #wait to ensure piezo actuator has settled into position.
+        logger.debug('last write: %s', self.last_write_values)
+
+    def run_trajectory(self, xs: np.ndarray,
+                             ys: np.ndarray,
+                             zs: np.ndarray,
+                             rate_hz: float) -> None:
+        '''
+        Moves through a sequence of x,y,z positions in microns, clocked out
+        by the DAQ hardware at rate_hz samples per second.
+
+        The whole trajectory is written to the DAQ buffer before it starts,
+        which is much faster than calling go_to_position for each point.
+        This call blocks until the trajectory has completed. A trajectory of
+        a single point is moved to with go_to_position. If the trajectory is
+        aborted, the last written position is unknown, so the next move must
+        specify every axis or read the position back.
+
+        raises ValueError if xs, ys and zs are not the same length, if any
+        position is out of bounds or not finite, or if rate_hz is not positive.
+        '''
+        self._check_open()
+        if not rate_hz > 0:
+            raise ValueError(f'rate_hz must be positive. got {rate_hz}')
 
-        logger.info(f'go to position {" ".join(debug_string)}')
+        positions = np.vstack([np.asarray(xs, dtype=np.float64),
+                               np.asarray(ys, dtype=np.float64),
+                               np.asarray(zs, dtype=np.float64)])
+        n_samples = positions.shape[1]
+        if n_samples == 0:
+            return
 
-        time.sleep(self.settling_time_in_seconds) #wait to ensure piezo actuator has settled into position.
-        logger.debug(f'last write: {self.last_write_values}')
+        in_range = (positions >= self._minimum_allowed_position) & (positions <= self._maximum_allowed_position)
+        if not in_range.all():
+            raise ValueError(f'trajectory contains positions outside of allowed range ({self.minimum_allowed_position:.2f}, {self.maximum_allowed_position:.2f}).')
+
+        if n_samples == 1:
+            # finite generation needs at least two samples
+            self.go_to_position(*positions[:, 0].tolist())
+            return
+
+        volts = positions * np.array(self._inv_scale)[:, np.newaxis] + self._offset_array[:, np.newaxis]
+
+        # the stage is somewhere along the path until the trajectory completes
+        self.last_write_values = [None, None, None]
+        self._last_write_volts = [None, None, None]
+
+        self._ao_task.timing.cfg_samp_clk_timing(rate = rate_hz,
+                                                 sample_mode = nidaqmx.constants.AcquisitionType.FINITE,
+                                                 samps_per_chan = n_samples)
+        try:
+            writer = nidaqmx.stream_writers.AnalogMultiChannelWriter(self._ao_task.out_stream)
+            writer.write_many_sample(np.ascontiguousarray(volts))
+            self._ao_task.start()
+            self._ao_task.wait_until_done(timeout = n_samples / rate_hz + 10.0)
+        finally:
+            self._ao_task.stop()
+            # return to software timed single point writes for go_to_position
+            # and commit the task again so those writes stay cheap.
+            self._ao_task.timing.samp_timing_type = nidaqmx.constants.SampleTimingType.ON_DEMAND
+            self._ao_task.control(nidaqmx.constants.TaskMode.TASK_COMMIT)
+
+        self.last_write_values = positions[:, -1].tolist()
+        self._last_write_volts = volts[:, -1].tolist()
+        logger.debug('last write: %s', self.last_write_values)
+
+    def _read_voltage(self) -> np.ndarray:
+        '''
+        Reads one sample from each input channel into the preallocated buffer
+        and returns the buffer.
+        '''
+        self._check_open()
+        self._ai_reader.read_one_sample(self._ai_buffer)
+        return self._ai_buffer
 
     def get_current_voltage(self) -> List[float]:
         '''
@@ -179,15 +428,7 @@ class PiezoControl(BaseControl):
         '''
         output = [-1,-1,-1]
         if self.read_channels is not None:
-            with nidaqmx.Task() as xread, nidaqmx.Task() as yread, nidaqmx.Task() as zread:
-
-                 xread.ai_channels.add_ai_voltage_chan(self.device_name + '/' + self.read_channels[0], min_val = 0, max_val = 10.0)
-                 yread.ai_channels.add_ai_voltage_chan(self.device_name + '/' + self.read_channels[1], min_val = 0, max_val = 10.0)
-                 zread.ai_channels.add_ai_voltage_chan(self.device_name + '/' + self.read_channels[2], min_val = 0, max_val = 10.0)
-
-                 output[0] = xread.read()
-                 output[1] = yread.read()
-                 output[2] = zread.read()
+            output = self._read_voltage().tolist()
 
         return output
 
@@ -203,4 +444,27 @@ class PiezoControl(BaseControl):
             return self.last_write_values
 
         else:
-            return [self._volts_to_microns(v, i) for i, v in enumerate(self.get_current_voltage())]
+            return (self._scale_array * (self._read_voltage() - self._offset_array)).tolist()
+
+    def close(self) -> None:
+        '''
+        Closes the analog output and input tasks, releasing the DAQ channels.
+
+        The controller cannot be used after it has been closed; moves and
+        reads raise RuntimeError. Calling
+        close more than once has no effect. Alternatively, use the controller
+        as a context manager so the channels are released on exit:
+
+            with PiezoControl('Dev1') as pcon:
+                pcon.go_to_position(x = 20, y = 20, z = 20)
+        '''
+        ao_task, ai_task = self._ao_task, self._ai_task
+        self._ao_task = None
+        self._ai_task = None
+        self._ai_reader = None
+        try:
+            if ao_task is not None:
+                ao_task.close()
+        finally:
+            if ai_task is not None:
+                ai_task.close()